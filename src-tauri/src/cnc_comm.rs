@@ -1,8 +1,20 @@
 use anyhow::{anyhow, Result};
 use serde::{Deserialize, Serialize};
+use socket2::{Domain, Protocol, Socket, Type};
+use std::fmt::Write as _;
 use std::io::{Read, Write};
-use std::net::{Ipv4Addr, TcpStream, UdpSocket};
-use std::time::Duration;
+use std::net::{Ipv4Addr, SocketAddr, TcpStream, UdpSocket};
+use std::ops::ControlFlow;
+use std::time::{Duration, Instant, SystemTime};
+
+// Largest discovery datagram we expect from the WiFi module
+const DISCOVERY_PACKET_SIZE: usize = 1024;
+// Number of datagrams drained per receive syscall during discovery
+const DISCOVERY_BATCH_SIZE: usize = 64;
+// Bytes of a rejected non-JSON discovery packet shown in the log
+const NON_JSON_PREVIEW_SIZE: usize = 64;
+// Kernel receive buffer for discovery; UDP has no autotuning like TCP
+const DISCOVERY_RECV_BUFFER_SIZE: usize = 4 * 1024 * 1024;
 
 #[derive(Debug, Clone, Serialize, Deserialize)]
 pub struct CncDevice {
@@ -28,6 +40,356 @@ struct GenmitsuBroadcast {
     uuid: String, // MAC address in uuid field
 }
 
+/// Write buffered discovery messages to stdout in one call and clear the buffer
+fn flush_log(log: &mut String) {
+    if !log.is_empty() {
+        let _ = std::io::stdout().lock().write_all(log.as_bytes());
+        log.clear();
+    }
+}
+
+/// Cheap pre-filter for discovery packets: only something framed as a JSON
+/// object is worth handing to serde_json.
+fn looks_like_json_object(data: &[u8]) -> bool {
+    let data = data.trim_ascii();
+    data.first() == Some(&b'{') && data.last() == Some(&b'}')
+}
+
+/// Receive on a non-blocking `socket` until `deadline`, handing each datagram
+/// to `on_packet` with its sender, how long it sat in the receive queue (when
+/// the platform reports arrival times) and the batch log buffer. Generic over
+/// the handler so it is inlined into the loop; stops early when `on_packet`
+/// returns `ControlFlow::Break`.
+fn drain_until<F>(socket: &UdpSocket, deadline: Instant, mut on_packet: F) -> std::io::Result<()>
+where
+    F: FnMut(&[u8], SocketAddr, Option<Duration>, &mut String) -> ControlFlow<()>,
+{
+    let mut batch = RecvBatch::new();
+    // Per-packet messages are collected here and written once per batch
+    // so a burst is not throttled by stdout
+    let mut log = String::new();
+
+    loop {
+        let remaining = deadline.saturating_duration_since(Instant::now());
+        if remaining.is_zero() || !wait_readable(socket, remaining)? {
+            return Ok(());
+        }
+
+        if let Err(e) = batch.recv(socket) {
+            println!("Multicast receive error: {}", e);
+            continue;
+        }
+
+        // One clock read per batch to turn arrival stamps into queueing delay
+        let now = SystemTime::now();
+        for (data, addr, arrived) in batch.packets() {
+            let queued = arrived.and_then(|t| now.duration_since(t).ok());
+            if on_packet(data, addr, queued, &mut log).is_break() {
+                flush_log(&mut log);
+                return Ok(());
+            }
+        }
+        flush_log(&mut log);
+    }
+}
+
+/// IPv4 addresses of this machine's multicast-capable LAN interfaces, with
+/// the interface carrying the default route first; empty if no suitable
+/// interface is found. Looked up fresh on every call so discovery follows
+/// network changes (new Wi-Fi network, DHCP lease) while the app is running.
+fn local_ipv4s() -> Vec<Ipv4Addr> {
+    let mut ips = interface_ipv4s();
+    // A default route over a skipped interface (e.g. a VPN) is ignored
+    if let Some(routed) = routed_ipv4() {
+        match ips.iter().position(|&ip| ip == routed) {
+            Some(index) => ips[..=index].rotate_right(1),
+            None if ips.is_empty() => ips.push(routed),
+            None => {}
+        }
+    }
+    ips
+}
+
+/// Read the addresses of all running, multicast-capable interfaces straight
+/// from the kernel - no network traffic involved. Loopback and point-to-point
+/// links (VPN tun/utun) are skipped since the CNC cannot be on them.
+#[cfg(unix)]
+fn interface_ipv4s() -> Vec<Ipv4Addr> {
+    let mut ifaddrs: *mut libc::ifaddrs = std::ptr::null_mut();
+    if unsafe { libc::getifaddrs(&mut ifaddrs) } != 0 {
+        return Vec::new();
+    }
+
+    let wanted = (libc::IFF_UP | libc::IFF_RUNNING | libc::IFF_MULTICAST) as libc::c_uint;
+    let unwanted = (libc::IFF_LOOPBACK | libc::IFF_POINTOPOINT) as libc::c_uint;
+    let mut found = Vec::new();
+    let mut cursor = ifaddrs;
+    while let Some(ifa) = unsafe { cursor.as_ref() } {
+        cursor = ifa.ifa_next;
+
+        let flags = ifa.ifa_flags as libc::c_uint;
+        if flags & wanted != wanted || flags & unwanted != 0 {
+            continue;
+        }
+        let Some(addr) = (unsafe { ifa.ifa_addr.as_ref() }) else {
+            continue;
+        };
+        if addr.sa_family as libc::c_int != libc::AF_INET {
+            continue;
+        }
+
+        let addr = unsafe { &*(ifa.ifa_addr as *const libc::sockaddr_in) };
+        let ip = Ipv4Addr::from(u32::from_be(addr.sin_addr.s_addr));
+        if !found.contains(&ip) {
+            found.push(ip);
+        }
+    }
+
+    unsafe { libc::freeifaddrs(ifaddrs) };
+    found
+}
+
+#[cfg(not(unix))]
+fn interface_ipv4s() -> Vec<Ipv4Addr> {
+    Vec::new()
+}
+
+/// Let the routing table pick the outbound (default route) interface.
+/// Connecting a UDP socket sends nothing; it only resolves the local address.
+fn routed_ipv4() -> Option<Ipv4Addr> {
+    let socket = UdpSocket::bind("0.0.0.0:0").ok()?;
+    socket.connect("8.8.8.8:80").ok()?;
+    match socket.local_addr().ok()? {
+        SocketAddr::V4(addr) => Some(*addr.ip()),
+        SocketAddr::V6(_) => None,
+    }
+}
+
+/// Ask the kernel to stamp each received datagram with its arrival time
+/// (SO_TIMESTAMPNS), so queueing delay can be reported without a clock read
+/// per packet. Failure only loses the diagnostic.
+#[cfg(target_os = "linux")]
+fn enable_rx_timestamps(socket: &UdpSocket) {
+    use std::os::fd::AsRawFd;
+
+    let enable: libc::c_int = 1;
+    let result = unsafe {
+        libc::setsockopt(
+            socket.as_raw_fd(),
+            libc::SOL_SOCKET,
+            libc::SO_TIMESTAMPNS,
+            &enable as *const libc::c_int as *const libc::c_void,
+            std::mem::size_of::<libc::c_int>() as libc::socklen_t,
+        )
+    };
+    if result != 0 {
+        println!(
+            "⚠️  Could not enable receive timestamps: {}",
+            std::io::Error::last_os_error()
+        );
+    }
+}
+
+#[cfg(not(target_os = "linux"))]
+fn enable_rx_timestamps(_socket: &UdpSocket) {}
+
+/// Extract the SCM_TIMESTAMPNS arrival time from a received message, if any
+#[cfg(target_os = "linux")]
+fn rx_timestamp(hdr: &libc::msghdr) -> Option<SystemTime> {
+    let mut cmsg = unsafe { libc::CMSG_FIRSTHDR(hdr) };
+    while let Some(c) = unsafe { cmsg.as_ref() } {
+        if c.cmsg_level == libc::SOL_SOCKET && c.cmsg_type == libc::SCM_TIMESTAMPNS {
+            let ts =
+                unsafe { std::ptr::read_unaligned(libc::CMSG_DATA(cmsg) as *const libc::timespec) };
+            return Some(
+                SystemTime::UNIX_EPOCH + Duration::new(ts.tv_sec as u64, ts.tv_nsec as u32),
+            );
+        }
+        cmsg = unsafe { libc::CMSG_NXTHDR(hdr, cmsg) };
+    }
+    None
+}
+
+/// Wait until `socket` has a datagram queued or `timeout` elapses.
+/// Returns false on timeout.
+#[cfg(unix)]
+fn wait_readable(socket: &UdpSocket, timeout: Duration) -> std::io::Result<bool> {
+    use std::os::fd::AsRawFd;
+
+    let mut pollfd = libc::pollfd {
+        fd: socket.as_raw_fd(),
+        events: libc::POLLIN,
+        revents: 0,
+    };
+    // Round up so a sub-millisecond remainder still waits instead of spinning
+    let timeout_ms = timeout
+        .as_micros()
+        .div_ceil(1000)
+        .min(libc::c_int::MAX as u128) as libc::c_int;
+
+    match unsafe { libc::poll(&mut pollfd, 1, timeout_ms) } {
+        -1 => {
+            let err = std::io::Error::last_os_error();
+            if err.kind() == std::io::ErrorKind::Interrupted {
+                // Let the caller re-check its deadline and wait again
+                Ok(true)
+            } else {
+                Err(err)
+            }
+        }
+        0 => Ok(false),
+        _ => Ok(true),
+    }
+}
+
+/// Fallback for platforms without poll(2): a blocking peek with a read timeout.
+/// Anything other than a timeout counts as readable; a failing datagram (e.g.
+/// WSAEMSGSIZE for an oversized one) is then reported by `RecvBatch::recv`.
+#[cfg(not(unix))]
+fn wait_readable(socket: &UdpSocket, timeout: Duration) -> std::io::Result<bool> {
+    let mut probe = [0u8; DISCOVERY_PACKET_SIZE];
+    socket.set_nonblocking(false)?;
+    socket.set_read_timeout(Some(timeout))?;
+    let result = socket.peek_from(&mut probe);
+    socket.set_nonblocking(true)?;
+
+    match result {
+        Err(e)
+            if matches!(
+                e.kind(),
+                std::io::ErrorKind::TimedOut | std::io::ErrorKind::WouldBlock
+            ) =>
+        {
+            Ok(false)
+        }
+        _ => Ok(true),
+    }
+}
+
+/// Receive buffers for the discovery socket, allocated once and reused for
+/// every drain so the receive loop itself never allocates.
+struct RecvBatch {
+    bufs: Vec<[u8; DISCOVERY_PACKET_SIZE]>,
+    // (size, sender, kernel arrival time if the platform reports it)
+    received: Vec<(usize, SocketAddr, Option<SystemTime>)>,
+    #[cfg(target_os = "linux")]
+    addrs: Vec<libc::sockaddr_in>,
+    // Ancillary data space for the SCM_TIMESTAMPNS control message
+    #[cfg(target_os = "linux")]
+    controls: Vec<[u64; 8]>,
+    #[cfg(target_os = "linux")]
+    iovecs: Vec<libc::iovec>,
+    #[cfg(target_os = "linux")]
+    msgs: Vec<libc::mmsghdr>,
+}
+
+impl RecvBatch {
+    fn new() -> Self {
+        Self {
+            bufs: vec![[0u8; DISCOVERY_PACKET_SIZE]; DISCOVERY_BATCH_SIZE],
+            received: Vec::with_capacity(DISCOVERY_BATCH_SIZE),
+            #[cfg(target_os = "linux")]
+            addrs: vec![unsafe { std::mem::zeroed() }; DISCOVERY_BATCH_SIZE],
+            #[cfg(target_os = "linux")]
+            controls: vec![[0u64; 8]; DISCOVERY_BATCH_SIZE],
+            #[cfg(target_os = "linux")]
+            iovecs: vec![unsafe { std::mem::zeroed() }; DISCOVERY_BATCH_SIZE],
+            #[cfg(target_os = "linux")]
+            msgs: vec![unsafe { std::mem::zeroed() }; DISCOVERY_BATCH_SIZE],
+        }
+    }
+
+    /// Datagrams filled by the last `recv`, in arrival order
+    fn packets(&self) -> impl Iterator<Item = (&[u8], SocketAddr, Option<SystemTime>)> {
+        self.bufs
+            .iter()
+            .zip(&self.received)
+            .map(|(buf, &(size, addr, arrived))| (&buf[..size], addr, arrived))
+    }
+
+    /// Drain the datagrams already queued on `socket` without blocking and
+    /// return how many were received. Uses recvmmsg(2) so a burst of
+    /// broadcasts costs a single syscall instead of one per packet.
+    #[cfg(target_os = "linux")]
+    fn recv(&mut self, socket: &UdpSocket) -> std::io::Result<usize> {
+        use std::os::fd::AsRawFd;
+
+        self.received.clear();
+
+        // Re-point the headers every call: the kernel rewrites msg_namelen
+        // and msg_controllen
+        for ((((msg, iov), addr), control), buf) in self
+            .msgs
+            .iter_mut()
+            .zip(self.iovecs.iter_mut())
+            .zip(self.addrs.iter_mut())
+            .zip(self.controls.iter_mut())
+            .zip(self.bufs.iter_mut())
+        {
+            iov.iov_base = buf.as_mut_ptr() as *mut libc::c_void;
+            iov.iov_len = buf.len();
+            msg.msg_hdr.msg_name = addr as *mut libc::sockaddr_in as *mut libc::c_void;
+            msg.msg_hdr.msg_namelen = std::mem::size_of::<libc::sockaddr_in>() as libc::socklen_t;
+            msg.msg_hdr.msg_iov = iov;
+            msg.msg_hdr.msg_iovlen = 1;
+            msg.msg_hdr.msg_control = control.as_mut_ptr() as *mut libc::c_void;
+            msg.msg_hdr.msg_controllen = std::mem::size_of_val(control) as _;
+        }
+
+        // MSG_DONTWAIT with a NULL timeout returns whatever is queued right now;
+        // the recvmmsg timeout argument is only checked between datagrams
+        let received = unsafe {
+            libc::recvmmsg(
+                socket.as_raw_fd(),
+                self.msgs.as_mut_ptr(),
+                self.msgs.len() as libc::c_uint,
+                libc::MSG_DONTWAIT,
+                std::ptr::null_mut(),
+            )
+        };
+        if received < 0 {
+            let err = std::io::Error::last_os_error();
+            if err.kind() == std::io::ErrorKind::WouldBlock {
+                return Ok(0);
+            }
+            return Err(err);
+        }
+
+        for (msg, addr) in self.msgs[..received as usize].iter().zip(&self.addrs) {
+            let ip = Ipv4Addr::from(u32::from_be(addr.sin_addr.s_addr));
+            let port = u16::from_be(addr.sin_port);
+            self.received.push((
+                msg.msg_len as usize,
+                SocketAddr::from((ip, port)),
+                rx_timestamp(&msg.msg_hdr),
+            ));
+        }
+
+        Ok(self.received.len())
+    }
+
+    /// Fallback for platforms without recvmmsg(2) (macOS, BSD, Windows):
+    /// drain the queue with non-blocking recv_from calls so a burst is still
+    /// handled in a single wake-up.
+    #[cfg(not(target_os = "linux"))]
+    fn recv(&mut self, socket: &UdpSocket) -> std::io::Result<usize> {
+        self.received.clear();
+
+        for buf in self.bufs.iter_mut() {
+            match socket.recv_from(buf) {
+                Ok((size, addr)) => self.received.push((size, addr, None)),
+                Err(e) if e.kind() == std::io::ErrorKind::WouldBlock => break,
+                // Hand back what was already read; a persistent error will
+                // surface again on the next drain once these are handled
+                Err(_) if !self.received.is_empty() => break,
+                Err(e) => return Err(e),
+            }
+        }
+
+        Ok(self.received.len())
+    }
+}
+
 pub struct CncManager {
     current_connection: Option<TcpStream>,
     device_info: Option<CncDevice>,
@@ -86,66 +448,122 @@ impl CncManager {
     fn multicast_discovery(&self, timeout_ms: u64) -> Result<Vec<CncDevice>> {
         let mut devices = Vec::new();
 
-        // Create UDP socket
-        let socket = UdpSocket::bind("0.0.0.0:1234")?;
-        socket.set_read_timeout(Some(Duration::from_millis(timeout_ms)))?;
-
-        // Join multicast group 224.0.0.251 (mDNS)
+        // Create UDP socket with a large receive buffer so a burst of
+        // announcements is queued rather than dropped while we probe devices
+        let socket = Socket::new(Domain::IPV4, Type::DGRAM, Some(Protocol::UDP))?;
+        // Share port 1234 with any other listener (vendor tools, a second app
+        // instance) instead of failing to bind; every bound socket still
+        // receives its own copy of each multicast announcement
+        socket.set_reuse_address(true)?;
+        #[cfg(all(
+            unix,
+            not(any(target_os = "solaris", target_os = "illumos", target_os = "cygwin"))
+        ))]
+        socket.set_reuse_port(true)?;
+        if let Err(e) = socket.set_recv_buffer_size(DISCOVERY_RECV_BUFFER_SIZE) {
+            println!("⚠️  Could not enlarge discovery receive buffer: {}", e);
+        }
+        // Linux reports double the requested size; macOS caps at kern.ipc.maxsockbuf
+        match socket.recv_buffer_size() {
+            Ok(size) => println!("📦 Discovery receive buffer: {} bytes", size),
+            Err(e) => println!("⚠️  Could not read discovery receive buffer size: {}", e),
+        }
+        socket.bind(&SocketAddr::from((Ipv4Addr::UNSPECIFIED, 1234)).into())?;
+        let socket: UdpSocket = socket.into();
+        // Waiting is done with poll(2) below; reads only drain what is queued
+        socket.set_nonblocking(true)?;
+        enable_rx_timestamps(&socket);
+
+        // Join multicast group 224.0.0.251 (mDNS) on every LAN interface.
+        // macOS only delivers group traffic to the interfaces named in a
+        // join, and a single INADDR_ANY join lets the kernel pick just one,
+        // which may be a bridge or second NIC rather than the CNC's network.
+        // INADDR_ANY stays as the fallback when no per-interface join works.
         let multicast_addr = Ipv4Addr::new(224, 0, 0, 251);
-        let interface_addr = Ipv4Addr::UNSPECIFIED;
-        socket.join_multicast_v4(&multicast_addr, &interface_addr)?;
-
-        println!("📡 Joined multicast group 224.0.0.251, listening for CNC devices...");
-
-        let start_time = std::time::Instant::now();
-        let mut buf = [0; 1024];
-
-        while start_time.elapsed() < Duration::from_millis(timeout_ms) {
-            match socket.recv_from(&mut buf) {
-                Ok((size, addr)) => {
-                    let data = &buf[..size];
-                    match std::str::from_utf8(data) {
-                        Ok(json_str) => {
-                            println!("📨 Received multicast from {}: {}", addr, json_str);
-                            match serde_json::from_str::<GenmitsuBroadcast>(json_str) {
-                                Ok(broadcast) => {
-                                    println!("🎯 Parsed Genmitsu device: {}", broadcast.name);
-
-                                    // Convert port string to u16
-                                    let port = broadcast.port.parse::<u16>().unwrap_or(10086);
-
-                                    // Probe the device to verify it's actually a CNC
-                                    if let Ok(mut device) = self.probe_device(&broadcast.ip, port) {
-                                        device.name = broadcast.name;
-                                        device.mac = Some(broadcast.uuid);
-                                        devices.push(device);
-                                        
-                                        // 🚀 SPEED IMPROVEMENT: Return immediately after first valid device
-                                        println!("✅ Found valid CNC device, connecting immediately!");
-                                        break;
-                                    }
-                                }
-                                Err(e) => {
-                                    println!("Failed to parse JSON: {}", e);
-                                }
+        let mut joined: Vec<Ipv4Addr> = local_ipv4s()
+            .into_iter()
+            .filter(|ip| socket.join_multicast_v4(&multicast_addr, ip).is_ok())
+            .collect();
+        if joined.is_empty() {
+            socket.join_multicast_v4(&multicast_addr, &Ipv4Addr::UNSPECIFIED)?;
+            joined.push(Ipv4Addr::UNSPECIFIED);
+        }
+
+        let joined_list = joined
+            .iter()
+            .map(|ip| ip.to_string())
+            .collect::<Vec<_>>()
+            .join(", ");
+        println!(
+            "📡 Joined multicast group 224.0.0.251 on {}, listening for CNC devices...",
+            joined_list
+        );
+
+        let deadline = Instant::now() + Duration::from_millis(timeout_ms);
+
+        drain_until(&socket, deadline, |data, addr, queued, log| {
+            // Announcements are JSON objects; packets from other senders on
+            // port 1234 are rejected without parsing
+            if !looks_like_json_object(data) {
+                let _ = writeln!(
+                    log,
+                    "Ignoring non-JSON multicast from {} ({} bytes): {:?}",
+                    addr,
+                    data.len(),
+                    String::from_utf8_lossy(&data[..data.len().min(NON_JSON_PREVIEW_SIZE)])
+                );
+                return ControlFlow::Continue(());
+            }
+
+            match std::str::from_utf8(data) {
+                Ok(json_str) => {
+                    let _ = match queued {
+                        Some(queued) => writeln!(
+                            log,
+                            "📨 Received multicast from {} (queued {:.1} ms): {}",
+                            addr,
+                            queued.as_secs_f64() * 1000.0,
+                            json_str
+                        ),
+                        None => writeln!(log, "📨 Received multicast from {}: {}", addr, json_str),
+                    };
+                    match serde_json::from_str::<GenmitsuBroadcast>(json_str) {
+                        Ok(broadcast) => {
+                            let _ = writeln!(log, "🎯 Parsed Genmitsu device: {}", broadcast.name);
+                            // Show progress before the (slow) probe
+                            flush_log(log);
+
+                            // Convert port string to u16
+                            let port = broadcast.port.parse::<u16>().unwrap_or(10086);
+
+                            // Probe the device to verify it's actually a CNC
+                            if let Ok(mut device) = self.probe_device(&broadcast.ip, port) {
+                                device.name = broadcast.name;
+                                device.mac = Some(broadcast.uuid);
+                                devices.push(device);
+
+                                // 🚀 SPEED IMPROVEMENT: Return immediately after first valid device
+                                println!("✅ Found valid CNC device, connecting immediately!");
+                                return ControlFlow::Break(());
                             }
                         }
                         Err(e) => {
-                            println!("Received non-UTF8 data: {:?}", e);
+                            let _ = writeln!(log, "Failed to parse JSON: {}", e);
                         }
                     }
                 }
                 Err(e) => {
-                    if e.kind() == std::io::ErrorKind::TimedOut {
-                        break;
-                    }
-                    println!("Multicast receive error: {}", e);
+                    let _ = writeln!(log, "Received non-UTF8 data: {:?}", e);
                 }
             }
-        }
+            ControlFlow::Continue(())
+        })?;
 
-        // Leave multicast group
-        socket.leave_multicast_v4(&multicast_addr, &interface_addr)?;
+        // Leave multicast group on every interface we joined. Best effort:
+        // closing the socket drops any membership a failed leave left behind
+        for interface_addr in &joined {
+            let _ = socket.leave_multicast_v4(&multicast_addr, interface_addr);
+        }
 
         Ok(devices)
     }